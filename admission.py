@@ -0,0 +1,46 @@
+"""
+Admission control for the Stable Diffusion API
+
+Requests share one pipeline, so under overload they pile up behind it and
+everyone's latency grows without bound. The gate caps how many requests may
+be queued or running at once; the rest are turned away with 429 so clients
+(or a load balancer) can back off or go elsewhere.
+"""
+
+import os
+import threading
+
+# Requests queued or running before new ones are turned away with 429 (0 = no limit)
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", "0"))
+
+
+class AdmissionGate:
+    """Counts requests in flight and refuses new ones beyond `limit`"""
+
+    def __init__(self, limit=MAX_QUEUE):
+        self.limit = max(limit, 0)
+        self._lock = threading.Lock()
+        self._depth = 0
+
+    @property
+    def depth(self):
+        """Number of admitted requests that haven't been released yet"""
+        with self._lock:
+            return self._depth
+
+    def try_admit(self):
+        """Reserve a slot, returning False if the gate is full
+
+        Check and reservation happen under one lock, so a burst of concurrent
+        requests can't all slip past the limit. Every successful call must be
+        paired with release().
+        """
+        with self._lock:
+            if self.limit and self._depth >= self.limit:
+                return False
+            self._depth += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._depth -= 1
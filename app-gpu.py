@@ -1,12 +1,17 @@
 import os
 import io
+import json
 import base64
 import random
-from flask import Flask, request, jsonify
+import hashlib
+from flask import Flask, Response, request, jsonify
 from diffusers import StableDiffusionPipeline
 import torch
 from PIL import Image
 import logging
+from lora_cache import LoraManager
+from admission import AdmissionGate
+from idempotency import IdempotencyCache, IdempotencyConflict
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,12 +19,19 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Global pipeline variable
+# Global pipeline variables
 pipeline = None
+lora_manager = None
+
+# Caps requests queued or running at once (MAX_QUEUE); the rest get 429
+admission = AdmissionGate()
+
+# Retries carrying the same Idempotency-Key share one generation
+idempotency = IdempotencyCache()
 
 def load_model():
     """Load the Stable Diffusion model with GPU optimization"""
-    global pipeline
+    global pipeline, lora_manager
     
     try:
         logger.info("Loading Stable Diffusion model...")
@@ -66,6 +78,9 @@ def load_model():
             # CPU optimizations
             pipeline.enable_attention_slicing()  # Reduce memory usage
         
+        # Per-request LoRA adapters are merged into the shared pipeline on demand
+        lora_manager = LoraManager(pipeline)
+        
         logger.info("Model loaded successfully!")
         
     except Exception as e:
@@ -77,7 +92,8 @@ def health_check():
     """Health check endpoint"""
     device_info = {
         "device": "cuda" if torch.cuda.is_available() else "cpu",
-        "model_loaded": pipeline is not None
+        "model_loaded": pipeline is not None,
+        "queue_depth": admission.depth
     }
     
     if torch.cuda.is_available():
@@ -88,6 +104,32 @@ def health_check():
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
+    """Generate image from text prompt, once per Idempotency-Key"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return run_generation()
+    
+    data = request.get_json(silent=True)
+    fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    try:
+        response, replayed = idempotency.run(
+            key,
+            fingerprint,
+            lambda: app.make_response(run_generation()),
+            keep=lambda response: response.status_code == 200  # Errors are worth retrying
+        )
+    except IdempotencyConflict as e:
+        return jsonify({"error": str(e)}), 422
+    
+    if not replayed:
+        return response
+    logger.info(f"Replaying response for Idempotency-Key {key}")
+    replay = Response(response.get_data(), status=response.status_code, headers=response.headers)
+    replay.headers["Idempotent-Replayed"] = "true"
+    return replay
+
+def run_generation():
     """Generate image from text prompt"""
     try:
         if pipeline is None:
@@ -100,6 +142,11 @@ def generate_image():
             
         prompt = data['prompt']
         
+        try:
+            lora_set = lora_manager.parse(data.get('loras'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         # Optional parameters with device-appropriate defaults
         device = "cuda" if torch.cuda.is_available() else "cpu"
         
@@ -127,15 +174,22 @@ def generate_image():
         # Generate image
         generator = torch.Generator(device=device).manual_seed(seed)
         
-        with torch.no_grad():
-            result = pipeline(
-                prompt=prompt,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                width=width,
-                height=height,
-                generator=generator
-            )
+        # Shed load rather than letting the queue (and everyone's latency) grow without bound
+        if not admission.try_admit():
+            return jsonify({"error": "Server busy, try again later"}), 429, {"Retry-After": "5"}
+        
+        try:
+            with lora_manager.activate(lora_set), torch.no_grad():
+                result = pipeline(
+                    prompt=prompt,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=guidance_scale,
+                    width=width,
+                    height=height,
+                    generator=generator
+                )
+        finally:
+            admission.release()
             
         image = result.images[0]
         
@@ -155,6 +209,7 @@ def generate_image():
             "guidance_scale": guidance_scale,
             "dimensions": f"{width}x{height}",
             "seed": seed,
+            "loras": [{"name": name, "weight": weight} for name, weight in lora_set],
             "device": device
         })
         
@@ -1,43 +1,83 @@
 import os
 import io
+import json
 import base64
 import random
-from flask import Flask, request, jsonify
+import hashlib
+from flask import Flask, Response, request, jsonify
 from diffusers import StableDiffusionPipeline
 import torch
 from PIL import Image
 import logging
+from lora_cache import LoraManager
+from admission import AdmissionGate
+from idempotency import IdempotencyCache, IdempotencyConflict
+from onnx_backend import load_onnx_pipeline
+from cpu_tuning import load_profile, apply_profile
+from tiny_pipeline import build_tiny_pipeline
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Inference engine: "pytorch", "onnxruntime" or "openvino"
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "pytorch")
+
+# Model to serve ("tiny" builds a small random pipeline offline, for testing the API)
+MODEL_ID = os.environ.get("MODEL_ID", "runwayml/stable-diffusion-v1-5")
+
+# Port to serve on (set per replica when running several behind gateway.py)
+PORT = int(os.environ.get("PORT", "8000"))
+
 app = Flask(__name__)
 
-# Global pipeline variable
+# Global pipeline variables
 pipeline = None
+lora_manager = None
 
-def load_model():
-    """Load the Stable Diffusion model optimized for CPU"""
-    global pipeline
-    
-    try:
-        logger.info("Loading Stable Diffusion model...")
-        
-        # Use a smaller, CPU-optimized model
-        model_id = "runwayml/stable-diffusion-v1-5"
-        
+# Caps requests queued or running at once (MAX_QUEUE); the rest get 429
+admission = AdmissionGate()
+
+# Retries carrying the same Idempotency-Key share one generation
+idempotency = IdempotencyCache()
+
+def load_torch_pipeline():
+    """Load the PyTorch pipeline for MODEL_ID optimized for CPU"""
+    if MODEL_ID == "tiny":
+        pipeline = build_tiny_pipeline()
+    else:
         # Load pipeline with CPU optimizations
         pipeline = StableDiffusionPipeline.from_pretrained(
-            model_id,
+            MODEL_ID,
             torch_dtype=torch.float32,  # Use float32 for CPU
             safety_checker=None,  # Disable safety checker for speed
             requires_safety_checker=False
         )
+    
+    # Move to CPU and optimize
+    pipeline = pipeline.to("cpu")
+    pipeline.enable_attention_slicing()  # Reduce memory usage
+    return pipeline
+
+def load_model():
+    """Load the Stable Diffusion model optimized for CPU"""
+    global pipeline, lora_manager
+    
+    try:
+        logger.info(f"Loading Stable Diffusion model ({INFERENCE_BACKEND} backend)...")
         
-        # Move to CPU and optimize
-        pipeline = pipeline.to("cpu")
-        pipeline.enable_attention_slicing()  # Reduce memory usage
+        # Thread counts and core pinning tuned for this host by autotune-cpu.py
+        apply_profile(load_profile())
+        
+        if INFERENCE_BACKEND != "pytorch":
+            # Run the exported graphs instead of eager PyTorch. The PyTorch model is only
+            # loaded when there is no cached export yet
+            pipeline = load_onnx_pipeline(MODEL_ID, INFERENCE_BACKEND, load_torch_pipeline)
+            lora_manager = LoraManager(pipeline, lora_dir=None)  # LoRA merging needs the PyTorch weights
+        else:
+            pipeline = load_torch_pipeline()
+            # Per-request LoRA adapters are merged into the shared pipeline on demand
+            lora_manager = LoraManager(pipeline)
         
         logger.info("Model loaded successfully!")
         
@@ -48,10 +88,41 @@ def load_model():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "model_loaded": pipeline is not None})
+    return jsonify({
+        "status": "healthy",
+        "model_loaded": pipeline is not None,
+        "backend": INFERENCE_BACKEND,
+        "queue_depth": admission.depth
+    })
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
+    """Generate image from text prompt, once per Idempotency-Key"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return run_generation()
+    
+    data = request.get_json(silent=True)
+    fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    try:
+        response, replayed = idempotency.run(
+            key,
+            fingerprint,
+            lambda: app.make_response(run_generation()),
+            keep=lambda response: response.status_code == 200  # Errors are worth retrying
+        )
+    except IdempotencyConflict as e:
+        return jsonify({"error": str(e)}), 422
+    
+    if not replayed:
+        return response
+    logger.info(f"Replaying response for Idempotency-Key {key}")
+    replay = Response(response.get_data(), status=response.status_code, headers=response.headers)
+    replay.headers["Idempotent-Replayed"] = "true"
+    return replay
+
+def run_generation():
     """Generate image from text prompt"""
     try:
         if pipeline is None:
@@ -64,6 +135,11 @@ def generate_image():
             
         prompt = data['prompt']
         
+        try:
+            lora_set = lora_manager.parse(data.get('loras'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         # Optional parameters with defaults for low resource usage
         num_inference_steps = data.get('steps', 20)  # Reduced steps for speed
         guidance_scale = data.get('guidance_scale', 7.5)
@@ -78,15 +154,22 @@ def generate_image():
         logger.info(f"Generating image for prompt: '{prompt}' with seed: {seed}")
         
         # Generate image
-        with torch.no_grad():
-            result = pipeline(
-                prompt=prompt,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                width=width,
-                height=height,
-                generator=torch.Generator().manual_seed(seed)  # Use provided or random seed
-            )
+        # Shed load rather than letting the queue (and everyone's latency) grow without bound
+        if not admission.try_admit():
+            return jsonify({"error": "Server busy, try again later"}), 429, {"Retry-After": "5"}
+        
+        try:
+            with lora_manager.activate(lora_set), torch.no_grad():
+                result = pipeline(
+                    prompt=prompt,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=guidance_scale,
+                    width=width,
+                    height=height,
+                    generator=torch.Generator().manual_seed(seed)  # Use provided or random seed
+                )
+        finally:
+            admission.release()
             
         image = result.images[0]
         
@@ -105,7 +188,8 @@ def generate_image():
             "steps": num_inference_steps,
             "guidance_scale": guidance_scale,
             "dimensions": f"{width}x{height}",
-            "seed": seed
+            "seed": seed,
+            "loras": [{"name": name, "weight": weight} for name, weight in lora_set]
         })
         
     except Exception as e:
@@ -117,4 +201,4 @@ if __name__ == '__main__':
     load_model()
     
     # Run Flask app
-    app.run(host='0.0.0.0', port=8000, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+CPU autotuner for the Stable Diffusion API
+
+Sweeps torch thread counts, worker process counts and core pinning layouts
+against a short benchmark generation and writes the best configuration to
+the per-host profile that load_model() applies at startup. Worker counts
+whose measured memory use would not fit in the memory available are skipped.
+
+    python autotune-cpu.py                  # Tune for throughput with the real model
+    python autotune-cpu.py --objective latency
+    python autotune-cpu.py --model-id tiny  # Quick smoke test of the tuner itself
+"""
+
+import sys
+import argparse
+
+import cpu_tuning
+
+
+def parse_counts(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def describe(config):
+    pinning = config["pinning"]
+    if config["worker_cpus"][0]:
+        pinning += " " + " | ".join(",".join(map(str, cpus)) for cpus in config["worker_cpus"])
+    return (f"workers={config['workers']} intra-op={config['intra_op_threads']} "
+            f"inter-op={config['inter_op_threads']} pinning={pinning}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the best CPU threading layout for this host")
+    parser.add_argument("--model-id", default="runwayml/stable-diffusion-v1-5",
+                        help="Model to benchmark with, or 'tiny' for the offline test pipeline")
+    parser.add_argument("--steps", type=int, default=5, help="Inference steps per benchmark image")
+    parser.add_argument("--size", type=int, default=512, help="Benchmark image width and height")
+    parser.add_argument("--runs", type=int, default=2, help="Timed images per worker (after one warm-up)")
+    parser.add_argument("--workers", type=parse_counts, default=[1, 2, 4], help="Worker counts to try, e.g. 1,2,4")
+    parser.add_argument("--inter-op", type=parse_counts, default=[1], help="Inter-op thread counts to try, e.g. 1,2")
+    parser.add_argument("--pinning", default=",".join(cpu_tuning.PINNING_LAYOUTS),
+                        help="Pinning layouts to try (none, compact, physical)")
+    parser.add_argument("--objective", choices=["throughput", "latency"], default="throughput",
+                        help="Optimise images/second across workers, or seconds for a single image")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the configurations that would be tried")
+    args = parser.parse_args()
+
+    pinnings = [p for p in args.pinning.split(",") if p]
+    for pinning in pinnings:
+        if pinning not in cpu_tuning.PINNING_LAYOUTS:
+            parser.error(f"unknown pinning layout '{pinning}'")
+
+    workers = [1] if args.objective == "latency" else args.workers
+    configs = list(cpu_tuning.candidate_configs(workers, args.inter_op, pinnings))
+
+    print(f"🔍 CPU autotune for host '{cpu_tuning.host_key()}'")
+    print(f"  CPUs available: {len(cpu_tuning.available_cpus())} "
+          f"({len(cpu_tuning.physical_cpus(cpu_tuning.available_cpus()))} physical cores)")
+    print(f"  CPU quota: {cpu_tuning.cpu_quota() or 'none'}")
+    memory = cpu_tuning.available_memory()
+    print(f"  Memory available: {f'{memory / 2**30:.1f} GB' if memory else 'unknown'}")
+    print(f"  Benchmark: {args.model_id}, {args.steps} steps at {args.size}x{args.size}, {args.runs} runs per worker")
+    print(f"  Configurations to try: {len(configs)}")
+
+    if args.dry_run:
+        for config in configs:
+            print(f"  - {describe(config)}")
+        return
+
+    benchmark = {"model_id": args.model_id, "steps": args.steps, "size": args.size, "runs": args.runs}
+    results = []
+    worker_memory = None  # Peak memory of one worker, measured by the trials so far
+
+    for i, config in enumerate(configs, 1):
+        print(f"\n[{i}/{len(configs)}] {describe(config)}")
+
+        # Leave some headroom: running out of memory gets workers killed mid trial
+        available = cpu_tuning.available_memory()
+        if worker_memory and available and config["workers"] * worker_memory > available * 0.9:
+            print(f"  ⏭  Skipped: {config['workers']} workers need about "
+                  f"{config['workers'] * worker_memory / 2**30:.1f} GB, {available / 2**30:.1f} GB available")
+            continue
+
+        try:
+            metrics = cpu_tuning.run_trial(config, benchmark)
+        except Exception as e:
+            print(f"  ❌ Failed: {e}")
+            continue
+
+        results.append({**config, **metrics})
+        worker_memory = max(worker_memory or 0, metrics["worker_memory"])
+        print(f"  {metrics['seconds_per_image']:.2f}s per image, {metrics['images_per_second']:.3f} images/s, "
+              f"{metrics['worker_memory'] / 2**30:.2f} GB per worker")
+
+    if not results:
+        print("\n❌ Every configuration failed - no profile written")
+        sys.exit(1)
+
+    best = cpu_tuning.best_result(results, args.objective)
+    profile = cpu_tuning.build_profile(best, {**benchmark, "objective": args.objective}, results)
+    path = cpu_tuning.save_profile(profile)
+
+    print(f"\n✅ Best: {describe(best)}")
+    print(f"  {best['seconds_per_image']:.2f}s per image, {best['images_per_second']:.3f} images/s")
+    print(f"  Profile written to {path}")
+    if best["workers"] > 1:
+        print(f"💡 Run {best['workers']} API replicas with WORKER_INDEX=0..{best['workers'] - 1} "
+              f"so each one uses its own CPU slice")
+        single = profile["single_worker"]
+        if single:
+            print(f"  A single API process (no WORKER_INDEX) uses the best one-worker layout: {describe(single)}")
+        else:
+            print("  ⚠️  No one-worker layout was measured, so a single API process falls back to default threading")
+
+
+if __name__ == "__main__":
+    main()
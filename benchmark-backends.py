@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark and parity check for the inference backends
+
+Runs the same seeded generation on the PyTorch pipeline and on each ONNX
+backend, reports the average generation time per backend and checks that the
+ONNX images match the PyTorch one. Uses the tiny offline pipeline by default,
+so it runs anywhere in seconds; pass --model-id to benchmark a real model.
+
+    python benchmark-backends.py
+    python benchmark-backends.py --model-id runwayml/stable-diffusion-v1-5 --steps 20 --size 512
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from onnx_backend import load_onnx_pipeline, BACKEND_PROVIDERS, ONNX_CACHE_DIR
+from tiny_pipeline import build_tiny_pipeline
+
+
+def load_pytorch_pipeline(model_id):
+    """Load the PyTorch pipeline the same way app-cpu.py does"""
+    if model_id == "tiny":
+        return build_tiny_pipeline()
+
+    from diffusers import StableDiffusionPipeline
+
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        model_id,
+        torch_dtype=torch.float32,
+        safety_checker=None,
+        requires_safety_checker=False
+    )
+    pipeline = pipeline.to("cpu")
+    pipeline.enable_attention_slicing()
+    return pipeline
+
+
+def generate(pipeline, args):
+    """Run one seeded generation and return the image as a float array in [0, 1]"""
+    result = pipeline(
+        prompt=args.prompt,
+        num_inference_steps=args.steps,
+        guidance_scale=7.5,
+        width=args.size,
+        height=args.size,
+        generator=torch.Generator().manual_seed(args.seed),
+        output_type="np"
+    )
+    return np.asarray(result.images[0])
+
+
+def benchmark(pipeline, args):
+    """Return (average seconds per image, image) after one warm-up run"""
+    image = generate(pipeline, args)
+
+    start = time.time()
+    for _ in range(args.runs):
+        generate(pipeline, args)
+    return (time.time() - start) / args.runs, image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PyTorch vs ONNX Runtime / OpenVINO inference")
+    parser.add_argument("--model-id", default="tiny", help="Hugging Face model id, or 'tiny' for the offline test pipeline")
+    parser.add_argument("--backends", default="onnxruntime,openvino", help="Comma separated ONNX backends to compare")
+    parser.add_argument("--prompt", default="a simple test image")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per backend (after one warm-up)")
+    parser.add_argument("--tolerance", type=float, default=1e-2, help="Max allowed pixel difference vs PyTorch")
+    parser.add_argument("--cache-dir", default=None, help="ONNX export cache (default: a fresh temp dir for the tiny model)")
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = tempfile.mkdtemp(prefix="onnx-") if args.model_id == "tiny" else ONNX_CACHE_DIR
+
+    print(f"Benchmarking '{args.model_id}': {args.steps} steps, {args.size}x{args.size}, {torch.get_num_threads()} threads")
+
+    torch_pipeline = load_pytorch_pipeline(args.model_id)
+    with torch.no_grad():
+        seconds, reference = benchmark(torch_pipeline, args)
+
+    results = [("pytorch", seconds, 0.0)]
+    failed = False
+
+    for backend in args.backends.split(","):
+        if backend not in BACKEND_PROVIDERS:
+            print(f"Unknown backend '{backend}', skipping")
+            continue
+
+        try:
+            onnx_pipeline = load_onnx_pipeline(args.model_id, backend, lambda: torch_pipeline, cache_dir)
+        except RuntimeError as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+
+        seconds, image = benchmark(onnx_pipeline, args)
+        max_diff = float(np.abs(image - reference).max())
+        results.append((backend, seconds, max_diff))
+        failed = failed or max_diff > args.tolerance
+
+    print()
+    print(f"{'Backend':<12} {'s/image':>10} {'speedup':>8} {'max diff':>10}")
+    for backend, seconds, max_diff in results:
+        speedup = results[0][1] / seconds
+        print(f"{backend:<12} {seconds:>10.3f} {speedup:>7.2f}x {max_diff:>10.2e}")
+
+    if failed:
+        print(f"\n✗ Parity check failed: an ONNX backend differs from PyTorch by more than {args.tolerance}")
+        sys.exit(1)
+    print("\n✓ Parity check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Bulk image generation client for the Stable Diffusion API
+
+Reads prompts (one JSON object per line, with optional per-prompt API
+parameters) and submits them concurrently over a pooled keep-alive
+connection. Images are decoded straight from the response stream to disk,
+and every finished prompt is recorded in a manifest so an interrupted run
+picks up where it left off.
+
+    python bulk-generate.py prompts.jsonl --output-dir out --concurrency 4
+
+Each line looks like:
+
+    {"id": "cat-1", "prompt": "a cute cat", "steps": 20, "seed": 42}
+
+Only "prompt" is required. The id (or "request_id") names the output file,
+falling back to the line number. Ids that repeat (or map to the same file
+name) get the line number appended so no two prompts share an output file.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Parameters passed through to /generate
+API_PARAMS = ("prompt", "steps", "guidance_scale", "width", "height", "seed", "loras")
+
+# Status codes worth retrying (overload and proxy/availability errors). A plain 500 is left
+# out: the API returns it for bad parameters too, which no amount of retrying fixes
+RETRY_STATUS = (429, 502, 503, 504)
+
+IMAGE_FIELD = re.compile(rb'"image"\s*:\s*"data:image/[a-z]+;base64,')
+
+
+class RetryableError(Exception):
+    """Request failed in a way that may succeed on retry"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def load_jobs(path, prompt_field):
+    """Read the prompt file into a list of jobs"""
+    jobs = []
+    filenames = set()
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            entry = json.loads(line)
+            if prompt_field not in entry:
+                print(f"⚠️  Line {line_number}: no '{prompt_field}' field, skipping")
+                continue
+
+            payload = {key: entry[key] for key in API_PARAMS if key in entry}
+            payload["prompt"] = entry[prompt_field]
+
+            job_id = str(entry.get("id", entry.get("request_id", f"line-{line_number:06d}")))
+            if output_filename({"id": job_id}) in filenames:
+                print(f"⚠️  Line {line_number}: id '{job_id}' already used, saving as '{job_id}-line-{line_number:06d}'")
+                job_id = f"{job_id}-line-{line_number:06d}"
+            filenames.add(output_filename({"id": job_id}))
+
+            jobs.append({"id": job_id, "payload": payload})
+    return jobs
+
+
+def idempotency_key(job):
+    """Stable key for a job: the same id and parameters always give the same key"""
+    canonical = json.dumps([job["id"], job["payload"]], sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def output_filename(job):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", job["id"]) + ".png"
+
+
+class Manifest:
+    """Append-only JSONL record of finished jobs, keyed by idempotency key"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written last line from an interrupted run
+                    if record.get("status") == "ok":
+                        self.done[record["key"]] = record
+
+    def is_done(self, key, output_dir):
+        record = self.done.get(key)
+        return record is not None and os.path.exists(os.path.join(output_dir, record["file"]))
+
+    def record(self, entry):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def stream_image_to_file(response, path):
+    """Decode the base64 image of a /generate response straight into `path`
+
+    Returns the rest of the response JSON (with "image" set to None), or the
+    whole JSON body if the response carries no image.
+    """
+    head = b""
+    tail = b""
+    pending = b""
+    image_file = None
+    state = "head"
+    tmp_path = path + ".part"
+
+    try:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            if state == "head":
+                head += chunk
+                match = IMAGE_FIELD.search(head)
+                if not match:
+                    continue
+                chunk = head[match.end():]
+                head = head[:match.start()]
+                image_file = open(tmp_path, "wb")
+                state = "image"
+
+            if state == "image":
+                end = chunk.find(b'"')
+                data = pending + (chunk if end == -1 else chunk[:end])
+                usable = len(data) - len(data) % 4
+                image_file.write(base64.b64decode(data[:usable]))
+                pending = data[usable:]
+                if end == -1:
+                    continue
+                chunk = chunk[end + 1:]
+                state = "tail"
+
+            tail += chunk
+
+        if image_file is None:
+            return json.loads(head)
+
+        if pending:
+            image_file.write(base64.b64decode(pending))
+        image_file.close()
+        os.replace(tmp_path, path)
+        return json.loads(head + b'"image":null' + tail)
+
+    finally:
+        if image_file is not None and not image_file.closed:
+            image_file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def submit(session, url, job, key, path, timeout):
+    """Send one job and save its image, raising RetryableError for transient failures"""
+    try:
+        with session.post(
+            f"{url}/generate",
+            json=job["payload"],
+            headers={"Idempotency-Key": key},
+            timeout=timeout,
+            stream=True
+        ) as response:
+            if response.status_code in RETRY_STATUS:
+                retry_after = response.headers.get("Retry-After")
+                raise RetryableError(
+                    f"HTTP {response.status_code}: {response.text.strip()[:200]}",
+                    float(retry_after) if retry_after and retry_after.isdigit() else None
+                )
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text.strip()[:200]}")
+
+            result = stream_image_to_file(response, path)
+            if not result.get("success") or not os.path.exists(path):
+                raise RuntimeError(result.get("error", "No image in response"))
+            return result
+
+    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+        raise RetryableError(str(e))
+
+
+def run_job(session, args, job, manifest):
+    """Run one job with retries and record the outcome in the manifest"""
+    key = idempotency_key(job)
+    filename = output_filename(job)
+    path = os.path.join(args.output_dir, filename)
+
+    # Pin the seed to the key so a retry (or rerun) reproduces the same image
+    if "seed" not in job["payload"]:
+        job["payload"]["seed"] = int(key[:8], 16)
+
+    start = time.time()
+    for attempt in range(1, args.retries + 2):
+        try:
+            result = submit(session, args.url, job, key, path, args.timeout)
+            entry = {
+                "id": job["id"],
+                "key": key,
+                "file": filename,
+                "status": "ok",
+                "seed": result.get("seed"),
+                "attempts": attempt,
+                "seconds": round(time.time() - start, 2)
+            }
+            manifest.record(entry)
+            return entry
+
+        except RetryableError as e:
+            if attempt > args.retries:
+                error = str(e)
+                break
+            # Exponential backoff with jitter, unless the server told us how long to wait
+            delay = e.retry_after or min(args.backoff * 2 ** (attempt - 1), 60) * random.uniform(0.5, 1.5)
+            time.sleep(delay)
+
+        except Exception as e:
+            error = str(e)
+            break
+
+    entry = {"id": job["id"], "key": key, "file": filename, "status": "failed", "error": error}
+    manifest.record(entry)
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate images for every prompt in a JSONL file")
+    parser.add_argument("prompts", help="JSONL file with one prompt object per line")
+    parser.add_argument("--url", default="http://localhost:8080", help="API base URL")
+    parser.add_argument("--output-dir", default="generated", help="Where images and the manifest go")
+    parser.add_argument("--concurrency", type=int, default=2, help="Requests in flight at once")
+    parser.add_argument("--retries", type=int, default=5, help="Retries per prompt for transient errors")
+    parser.add_argument("--backoff", type=float, default=2.0, help="Initial retry delay in seconds")
+    parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds")
+    parser.add_argument("--prompt-field", default="prompt", help="JSON field holding the prompt text")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(args.output_dir, "manifest.jsonl"))
+
+    jobs = load_jobs(args.prompts, args.prompt_field)
+    pending = [job for job in jobs if not manifest.is_done(idempotency_key(job), args.output_dir)]
+
+    print(f"📋 {len(jobs)} prompts, {len(jobs) - len(pending)} already done, {len(pending)} to generate")
+    if not pending:
+        return
+
+    # One keep-alive connection per concurrent request
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    start = time.time()
+    completed = failed = 0
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_job, session, args, job, manifest) for job in pending]
+        try:
+            for future in as_completed(futures):
+                entry = future.result()
+                completed += 1
+                elapsed = time.time() - start
+                eta = elapsed / completed * (len(pending) - completed)
+
+                if entry["status"] == "ok":
+                    print(f"✓ [{completed}/{len(pending)}] {entry['file']} "
+                          f"({entry['seconds']}s, ETA {eta / 60:.1f}m)")
+                else:
+                    failed += 1
+                    print(f"✗ [{completed}/{len(pending)}] {entry['id']}: {entry['error']}")
+
+        except KeyboardInterrupt:
+            print("\n⏹  Interrupted - finished prompts are in the manifest, rerun to resume")
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.time() - start
+    print(f"\n📊 {completed - failed} generated, {failed} failed in {elapsed / 60:.1f}m "
+          f"({(completed - failed) / elapsed * 60:.1f} images/min)")
+    if failed:
+        print("💡 Rerun the same command to retry the failed prompts")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
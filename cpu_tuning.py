@@ -0,0 +1,423 @@
+"""
+CPU thread and affinity tuning
+
+Per-host profiles record the torch intra/inter-op thread counts, the number
+of worker processes and the core pinning layout that gave the best results
+in autotune-cpu.py. load_model() applies the profile for the current host
+before the model is loaded, so the OpenMP thread pool is created with the
+tuned settings. A profile tuned for several workers also keeps the best
+single-worker layout, which is what a process uses unless WORKER_INDEX says
+it is one of several replicas.
+
+A "host" is identified by its CPU model and the CPUs the container may use
+(affinity and cgroup quota), so the profile survives container restarts and
+is shared by all identical machines mounting the same cache.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import queue
+import signal
+import socket
+import logging
+import resource
+import threading
+import multiprocessing
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Configuration (override with environment variables)
+CPU_PROFILE_DIR = os.environ.get("CPU_PROFILE_DIR", os.path.expanduser("~/.cache/cpu-profiles"))
+CPU_PROFILE = os.environ.get("CPU_PROFILE")  # Explicit profile path, skips the host lookup
+# Which worker slot of the profile this process uses; unset means the only process on the host
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.environ.get("WORKER_INDEX") else None
+
+PINNING_LAYOUTS = ("none", "compact", "physical")
+
+
+def available_cpus():
+    """Logical CPUs this process may run on"""
+    return sorted(os.sched_getaffinity(0))
+
+
+def cpu_quota():
+    """CPU limit from the cgroup (e.g. docker-compose `cpus: 8.0`), or None if unlimited"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:  # cgroup v2
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:  # cgroup v1
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def available_memory():
+    """Bytes of memory free for new processes (within the cgroup limit), or None if unknown"""
+    candidates = []
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    candidates.append(int(line.split()[1]) * 1024)
+    except (OSError, ValueError):
+        pass
+
+    for limit_file, usage_file in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),  # cgroup v2
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")  # cgroup v1
+    ):
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read())
+            if limit != "max":
+                candidates.append(max(0, int(limit) - usage))
+            break
+        except (OSError, ValueError):
+            continue
+
+    return min(candidates) if candidates else None
+
+
+def usable_cpu_count():
+    """Number of CPUs worth of compute we can actually use"""
+    count = len(available_cpus())
+    quota = cpu_quota()
+    if quota is not None:
+        count = min(count, max(1, math.ceil(quota)))
+    return count
+
+
+def physical_cpus(cpus):
+    """One logical CPU per physical core (drops SMT siblings)"""
+    seen = set()
+    physical = []
+    for cpu in cpus:
+        topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        try:
+            with open(os.path.join(topology, "physical_package_id")) as f:
+                package = f.read().strip()
+            with open(os.path.join(topology, "core_id")) as f:
+                core = f.read().strip()
+        except OSError:
+            return list(cpus)  # No topology information, treat every CPU as a core
+
+        if (package, core) not in seen:
+            seen.add((package, core))
+            physical.append(cpu)
+    return physical
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return "unknown-cpu"
+
+
+def host_key():
+    """Stable identifier for this machine shape, used as the profile file name"""
+    model = re.sub(r"[^a-z0-9]+", "-", cpu_model().lower()).strip("-")
+    key = f"{model}-{len(available_cpus())}cpu"
+    quota = cpu_quota()
+    if quota is not None:
+        key += f"-limit{quota:g}"
+    return key
+
+
+def profile_path():
+    return CPU_PROFILE or os.path.join(CPU_PROFILE_DIR, f"{host_key()}.json")
+
+
+def load_profile():
+    """Return the tuning profile for this host, or None if autotune hasn't been run here"""
+    path = profile_path()
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_profile(profile):
+    path = profile_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def apply_settings(intra_op_threads, inter_op_threads, cpus=None):
+    """Apply thread counts and pinning to the current process"""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    # For libraries that read these when they initialise their own pools
+    os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+    os.environ["MKL_NUM_THREADS"] = str(intra_op_threads)
+
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError as e:
+        # Can only be set once, before any inter-op parallel work has started
+        logger.warning(f"Could not set inter-op threads: {e}")
+
+
+def apply_profile(profile, worker_index=WORKER_INDEX):
+    """Apply a tuning profile to this process (worker slot `worker_index`, None if it runs alone)"""
+    if profile is None:
+        logger.info(f"No CPU tuning profile for host '{host_key()}', using default threading "
+                    f"(run autotune-cpu.py to create one)")
+        return
+
+    layout = profile
+    if worker_index is None:
+        worker_index = 0
+        if profile["workers"] > 1:
+            # Tuned for several replicas, but this process has the host to itself
+            layout = profile.get("single_worker")
+            if layout is None:
+                logger.warning(
+                    f"CPU tuning profile is for {profile['workers']} workers and has no single-worker layout; "
+                    f"using default threading (set WORKER_INDEX when running {profile['workers']} replicas, "
+                    f"or rerun autotune-cpu.py with --workers 1 included)"
+                )
+                return
+    elif worker_index >= profile["workers"]:
+        logger.warning(f"WORKER_INDEX={worker_index} but the profile was tuned for {profile['workers']} "
+                       f"worker(s); this replica shares CPUs with WORKER_INDEX={worker_index % profile['workers']}")
+
+    worker_cpus = layout["worker_cpus"][worker_index % layout["workers"]]
+    apply_settings(layout["intra_op_threads"], layout["inter_op_threads"], worker_cpus)
+
+    logger.info(
+        f"Applied CPU tuning profile: {layout['intra_op_threads']} intra-op / "
+        f"{layout['inter_op_threads']} inter-op threads, {layout['pinning']} pinning"
+        + (f" on CPUs {worker_cpus}" if worker_cpus else "")
+        + (f" (worker {worker_index % layout['workers'] + 1} of {layout['workers']})" if layout["workers"] > 1 else "")
+    )
+
+
+def candidate_configs(worker_counts, inter_op_counts, pinnings=PINNING_LAYOUTS):
+    """Yield the thread / worker / pinning layouts worth benchmarking on this host"""
+    cpus = available_cpus()
+    usable = usable_cpu_count()
+    pools = {
+        "none": None,
+        "compact": cpus[:usable],
+        "physical": physical_cpus(cpus)[:usable]
+    }
+
+    for workers in worker_counts:
+        if workers > usable:
+            continue
+
+        for pinning in pinnings:
+            if pinning == "physical" and pools["physical"] == pools["compact"]:
+                continue  # No SMT siblings in reach, same layout as compact
+            pool = pools[pinning]
+            budget = (len(pool) if pool else usable) // workers
+            if budget < 1:
+                continue
+
+            # Memory bound UNet steps often peak below one thread per core, so try fewer as well
+            for threads in sorted({budget, max(1, budget // 2), max(1, budget * 3 // 4)}, reverse=True):
+                for inter_op in inter_op_counts:
+                    yield {
+                        "workers": workers,
+                        "intra_op_threads": threads,
+                        "inter_op_threads": inter_op,
+                        "pinning": pinning,
+                        "worker_cpus": [pool[i * threads:(i + 1) * threads] if pool else None for i in range(workers)]
+                    }
+
+
+def _load_benchmark_pipeline(model_id):
+    if model_id == "tiny":
+        from tiny_pipeline import build_tiny_pipeline
+        return build_tiny_pipeline()
+
+    from diffusers import StableDiffusionPipeline
+
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        model_id,
+        torch_dtype=torch.float32,
+        safety_checker=None,
+        requires_safety_checker=False
+    )
+    pipeline = pipeline.to("cpu")
+    pipeline.enable_attention_slicing()
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def _benchmark_worker(config, index, benchmark, barrier, results):
+    """Run in a fresh process: apply `config`, then time the benchmark generation"""
+    try:
+        apply_settings(config["intra_op_threads"], config["inter_op_threads"], config["worker_cpus"][index])
+        pipeline = _load_benchmark_pipeline(benchmark["model_id"])
+
+        def generate():
+            with torch.no_grad():
+                pipeline(
+                    prompt="a photo of a lighthouse at sunset",
+                    num_inference_steps=benchmark["steps"],
+                    width=benchmark["size"],
+                    height=benchmark["size"],
+                    generator=torch.Generator().manual_seed(0)
+                )
+
+        generate()  # Warm up
+        barrier.wait()
+
+        start = time.time()
+        for _ in range(benchmark["runs"]):
+            generate()
+        results.put({
+            "index": index,
+            "start": start,
+            "end": time.time(),
+            "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        })
+
+    except threading.BrokenBarrierError:
+        # Another worker failed (or the barrier timed out); its own error is the one to report
+        results.put({"index": index, "error": "another worker failed or timed out", "aborted": True})
+
+    except Exception as e:
+        results.put({"index": index, "error": f"{type(e).__name__}: {e}"})
+        barrier.abort()
+
+
+def _describe_exit(exitcode):
+    if exitcode < 0:
+        name = signal.Signals(-exitcode).name
+        return f"was killed by {name}" + (" (out of memory?)" if name == "SIGKILL" else "")
+    return f"exited with code {exitcode}"
+
+
+def run_trial(config, benchmark, timeout=3600):
+    """Benchmark one configuration, running its workers side by side
+
+    Fails as soon as a worker reports an error or dies without reporting,
+    e.g. when the OOM killer takes it out.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(config["workers"], timeout=timeout)
+    results = ctx.Queue()
+
+    processes = [
+        ctx.Process(target=_benchmark_worker, args=(config, i, benchmark, barrier, results))
+        for i in range(config["workers"])
+    ]
+    for process in processes:
+        process.start()
+
+    timings = {}
+    finished = False
+    deadline = time.time() + timeout
+
+    def collect(wait):
+        timing = results.get(timeout=wait)
+        if "error" in timing and not timing.get("aborted"):
+            raise RuntimeError(f"Worker {timing['index']}: {timing['error']}")
+        timings[timing["index"]] = timing
+
+    try:
+        while len(timings) < len(processes):
+            try:
+                collect(1)
+                continue
+            except queue.Empty:
+                pass
+
+            exited = [i for i, process in enumerate(processes) if process.exitcode is not None and i not in timings]
+            if exited:
+                # Pick up anything it managed to send before exiting, then give up on it
+                try:
+                    while True:
+                        collect(1)
+                except queue.Empty:
+                    pass
+                for i in exited:
+                    if i not in timings:
+                        raise RuntimeError(f"Worker {i} {_describe_exit(processes[i].exitcode)} without a result")
+
+            if time.time() > deadline:
+                raise RuntimeError(f"Trial did not finish within {timeout}s")
+
+        finished = True
+
+    finally:
+        for process in processes:
+            if not finished:
+                process.terminate()
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    errors = [t["error"] for t in timings.values() if "error" in t]
+    if errors:
+        raise RuntimeError(errors[0])
+
+    timings = list(timings.values())
+    images = config["workers"] * benchmark["runs"]
+    wall_time = max(t["end"] for t in timings) - min(t["start"] for t in timings)
+    latencies = [(t["end"] - t["start"]) / benchmark["runs"] for t in timings]
+
+    return {
+        "seconds_per_image": sum(latencies) / len(latencies),
+        "images_per_second": images / wall_time,
+        "worker_memory": max(t["peak_memory"] for t in timings)
+    }
+
+
+def best_result(results, objective):
+    """The winning trial for `objective` ("throughput" or "latency"), or None"""
+    if not results:
+        return None
+    if objective == "throughput":
+        return max(results, key=lambda r: r["images_per_second"])
+    return min(results, key=lambda r: r["seconds_per_image"])
+
+
+def build_profile(config, benchmark, results):
+    """Assemble the profile that gets written for this host"""
+    # The layout a lone process (no WORKER_INDEX) uses when the winner needs several workers
+    single_worker = best_result([r for r in results if r["workers"] == 1], benchmark["objective"])
+    return {
+        "host": host_key(),
+        "hostname": socket.gethostname(),
+        "cpu_model": cpu_model(),
+        "cpus": available_cpus(),
+        "cpu_quota": cpu_quota(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmark": benchmark,
+        **config,
+        "single_worker": single_worker,
+        "results": results
+    }
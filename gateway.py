@@ -0,0 +1,388 @@
+"""
+Cache-affinity gateway for multiple Stable Diffusion API replicas
+
+Routes /generate by consistent hashing so related requests land on the same
+replica. Apart from replayed Idempotency-Key retries (which are pinned to
+their replica separately), the only cache the replicas have is the merged
+LoRA set, so requests with LoRAs are hashed on their adapter set alone and
+each set stays merged on one replica instead of thrashing on all of them.
+Requests without LoRAs are hashed on (model, prompt); every replica serves
+the same model (MODEL_ID), so in practice that is the prompt, which keeps
+repeats of a prompt together and spreads distinct prompts evenly. If the
+chosen replica is unhealthy, draining or already carrying more than its
+share of the work, the request goes to the replica with the fewest
+outstanding requests instead.
+
+Replicas are health-checked through /health in the background and can be
+drained (no new requests, in-flight ones finish) through the admin API:
+
+    python gateway.py --replicas http://localhost:8001,http://localhost:8002 --port 8080
+
+    curl -X POST localhost:8080/admin/drain -H "Content-Type: application/json" -d '{"replica": "http://localhost:8001"}'
+    curl localhost:8080/admin/replicas
+"""
+
+import os
+import math
+import time
+import bisect
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+# Headers passed through to the replicas
+FORWARD_HEADERS = ("Content-Type", "Idempotency-Key")
+
+# Recent Idempotency-Keys remembered, so retries go back to the replica holding the original
+PINNED_KEYS = 10000
+
+# Hop-by-hop headers that must not be copied back to the client
+HOP_HEADERS = ("connection", "keep-alive", "transfer-encoding", "content-length", "content-encoding")
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class Replica:
+    """One API replica and what the gateway knows about it"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.draining = False
+        self.outstanding = 0
+        self.failures = 0
+        self.last_health = None
+
+    def status(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "outstanding": self.outstanding,
+            "last_health": self.last_health
+        }
+
+
+class Router:
+    """Consistent hash ring with bounded load and least-outstanding fallback"""
+
+    def __init__(self, urls, vnodes=100, load_factor=1.25, unhealthy_after=2):
+        self.replicas = {url.rstrip("/"): Replica(url) for url in urls}
+        self.load_factor = load_factor
+        self.unhealthy_after = unhealthy_after
+        self.lock = threading.Lock()
+        self.pinned = OrderedDict()  # Idempotency-Key -> replica url, in LRU order
+
+        # The ring covers every configured replica; ineligible ones are skipped when
+        # walking it, so other keys keep their replica when one goes down
+        self.ring = sorted(
+            (ring_hash(f"{url}#{i}"), url)
+            for url in self.replicas
+            for i in range(vnodes)
+        )
+        self.ring_keys = [h for h, _ in self.ring]
+
+    def eligible(self):
+        return [r for r in self.replicas.values() if r.healthy and not r.draining]
+
+    def choose(self, key, exclude=(), idempotency_key=None):
+        """Pick a replica for `key` and count a request against it, or return None
+
+        A retry (same `idempotency_key`) goes back to the replica that got the
+        original whatever its load, since that replica can answer it without
+        generating the image again.
+        """
+        with self.lock:
+            candidates = [r for r in self.eligible() if r.url not in exclude]
+            if not candidates:
+                return None
+
+            pinned = self.replicas.get(self.pinned.get(idempotency_key)) if idempotency_key else None
+            chosen = pinned if pinned in candidates else self._hash_choice(key, candidates)
+
+            if idempotency_key:
+                self.pinned[idempotency_key] = chosen.url
+                self.pinned.move_to_end(idempotency_key)
+                while len(self.pinned) > PINNED_KEYS:
+                    self.pinned.popitem(last=False)
+
+            chosen.outstanding += 1
+            return chosen
+
+    def _hash_choice(self, key, candidates):
+        """Ring owner of `key` among `candidates`, unless it already carries more than its share"""
+        # Bounded load: a replica may carry at most load_factor times the average
+        total = sum(r.outstanding for r in candidates) + 1
+        capacity = math.ceil(total / len(candidates) * self.load_factor)
+
+        start = bisect.bisect(self.ring_keys, ring_hash(key))
+        chosen = None
+        for i in range(len(self.ring)):
+            replica = self.replicas[self.ring[(start + i) % len(self.ring)][1]]
+            if replica in candidates:
+                chosen = replica
+                break
+
+        if chosen.outstanding + 1 > capacity:
+            chosen = min(candidates, key=lambda r: r.outstanding)
+        return chosen
+
+    def release(self, replica):
+        with self.lock:
+            replica.outstanding -= 1
+
+    def mark(self, replica, healthy, info=None):
+        """Record a health check (or request) result for `replica`"""
+        with self.lock:
+            if healthy:
+                if not replica.healthy:
+                    logger.info(f"Replica {replica.url} is healthy")
+                replica.healthy = True
+                replica.failures = 0
+                replica.last_health = info
+            else:
+                replica.failures += 1
+                if replica.healthy and replica.failures >= self.unhealthy_after:
+                    logger.warning(f"Replica {replica.url} is unhealthy")
+                    replica.healthy = False
+
+    def mark_down(self, replica):
+        """Take a replica out of rotation right away (e.g. connection refused)"""
+        with self.lock:
+            if replica.healthy:
+                logger.warning(f"Replica {replica.url} is unreachable")
+            replica.healthy = False
+            replica.failures = max(replica.failures, self.unhealthy_after)
+
+
+class UpstreamBody:
+    """Response body streamed from a replica; frees the replica's slot when closed"""
+
+    def __init__(self, upstream, replica):
+        self.upstream = upstream
+        self.replica = replica
+        self.closed = False
+
+    def __iter__(self):
+        return self.upstream.iter_content(chunk_size=64 * 1024)
+
+    def close(self):
+        # Called by the WSGI server once the body is sent or the client went away
+        if not self.closed:
+            self.closed = True
+            self.upstream.close()
+            router.release(self.replica)
+
+
+router = None
+session = None
+settings = {}
+
+
+def health_loop(interval, timeout):
+    """Poll every replica's /health forever"""
+    while True:
+        for replica in list(router.replicas.values()):
+            try:
+                response = session.get(f"{replica.url}/health", timeout=timeout)
+                info = response.json() if response.status_code == 200 else None
+                router.mark(replica, bool(info and info.get("model_loaded")), info)
+            except (requests.RequestException, ValueError):
+                router.mark(replica, False)
+        time.sleep(interval)
+
+
+def lora_set_key(loras):
+    """Canonical form of the 'loras' parameter, matching the replicas' merged-set cache key"""
+    adapters = []
+    for item in loras:
+        if not isinstance(item, dict):
+            continue
+        weight = item.get("weight", 1.0)
+        if isinstance(weight, (int, float)) and not isinstance(weight, bool):
+            if weight == 0:
+                continue  # The replicas drop zero-weight adapters too
+            weight = float(weight)
+        adapters.append(f"{item.get('name')}:{weight}")
+    return ",".join(sorted(adapters))
+
+
+def routing_key(data):
+    """The LoRA set when there is one (that's what replicas cache), else the prompt"""
+    loras = data.get("loras")
+    if isinstance(loras, list):
+        adapter_set = lora_set_key(loras)
+        if adapter_set:
+            return f"loras\n{adapter_set}"
+    return f"prompt\n{data.get('prompt', '')}"
+
+
+def forward(replica, body, headers):
+    """Send the request to `replica`, returning a streaming Flask response
+
+    Returns None instead if the replica answered 429, so the caller can try
+    another one.
+    """
+    upstream = session.post(
+        f"{replica.url}/generate",
+        data=body,
+        headers=headers,
+        timeout=settings["timeout"],
+        stream=True
+    )
+    body = UpstreamBody(upstream, replica)
+
+    if upstream.status_code == 429:
+        body.close()
+        return None
+
+    response_headers = [(k, v) for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS]
+    response_headers.append(("X-Replica", replica.url))
+    return Response(body, status=upstream.status_code, headers=response_headers)
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Gateway health: healthy while at least one replica can take requests"""
+    eligible = router.eligible()
+    status = {
+        "status": "healthy" if eligible else "unhealthy",
+        "replicas_available": len(eligible),
+        "replicas_total": len(router.replicas),
+        "model_loaded": bool(eligible)
+    }
+    return jsonify(status), 200 if eligible else 503
+
+
+@app.route('/generate', methods=['POST'])
+def generate_image():
+    """Route a generation request to a replica"""
+    data = request.get_json(silent=True)
+    if not data or 'prompt' not in data:
+        return jsonify({"error": "Missing 'prompt' in request"}), 400
+
+    key = routing_key(data)
+    body = request.get_data()
+    headers = {h: request.headers[h] for h in FORWARD_HEADERS if h in request.headers}
+
+    # Try the preferred replica, then one more if it is down or shedding load
+    tried = []
+    busy = False
+    for _ in range(2):
+        replica = router.choose(key, exclude=tried, idempotency_key=request.headers.get('Idempotency-Key'))
+        if replica is None:
+            break
+        tried.append(replica.url)
+
+        try:
+            response = forward(replica, body, headers)
+        except requests.ConnectionError as e:
+            router.release(replica)
+            router.mark_down(replica)
+            logger.warning(f"Forwarding to {replica.url} failed: {e}")
+            continue
+        except requests.Timeout:
+            router.release(replica)
+            return jsonify({"error": f"Replica {replica.url} timed out"}), 504
+        except requests.RequestException as e:
+            router.release(replica)
+            logger.warning(f"Forwarding to {replica.url} failed: {e}")
+            return jsonify({"error": f"Bad response from replica {replica.url}"}), 502
+
+        if response is not None:
+            return response
+        busy = True
+
+    if busy:
+        return jsonify({"error": "All replicas busy, try again later"}), 429, {"Retry-After": "5"}
+    return jsonify({"error": "No healthy replicas available"}), 503
+
+
+@app.route('/admin/replicas', methods=['GET'])
+def list_replicas():
+    """Routing state of every replica"""
+    return jsonify({"replicas": [r.status() for r in router.replicas.values()]})
+
+
+@app.route('/admin/drain', methods=['POST'])
+def drain_replica():
+    """Stop sending new requests to a replica; with "wait": true, block until it is idle"""
+    data = request.get_json(silent=True) or {}
+    replica = router.replicas.get(str(data.get('replica', '')).rstrip("/"))
+    if replica is None:
+        return jsonify({"error": "Unknown replica"}), 404
+
+    replica.draining = True
+    logger.info(f"Draining replica {replica.url} ({replica.outstanding} requests in flight)")
+
+    if data.get('wait'):
+        deadline = time.time() + float(data.get('timeout', settings["timeout"]))
+        while replica.outstanding > 0 and time.time() < deadline:
+            time.sleep(0.5)
+
+    return jsonify({**replica.status(), "drained": replica.outstanding == 0})
+
+
+@app.route('/admin/undrain', methods=['POST'])
+def undrain_replica():
+    """Put a drained replica back into rotation"""
+    data = request.get_json(silent=True) or {}
+    replica = router.replicas.get(str(data.get('replica', '')).rstrip("/"))
+    if replica is None:
+        return jsonify({"error": "Unknown replica"}), 404
+
+    replica.draining = False
+    logger.info(f"Replica {replica.url} back in rotation")
+    return jsonify(replica.status())
+
+
+def main():
+    global router, session
+
+    parser = argparse.ArgumentParser(description="Cache-affinity load balancer for Stable Diffusion API replicas")
+    parser.add_argument("--replicas", default=os.environ.get("REPLICAS", ""),
+                        help="Comma separated replica base URLs (or REPLICAS env var)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8080")))
+    parser.add_argument("--vnodes", type=int, default=100, help="Virtual nodes per replica on the hash ring")
+    parser.add_argument("--load-factor", type=float, default=1.25,
+                        help="Max outstanding requests on a replica, relative to the average, before falling back")
+    parser.add_argument("--health-interval", type=float, default=5.0, help="Seconds between health checks")
+    parser.add_argument("--unhealthy-after", type=int, default=2, help="Failed health checks before a replica is taken out")
+    parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds")
+    args = parser.parse_args()
+
+    urls = [url for url in args.replicas.split(",") if url]
+    if not urls:
+        parser.error("no replicas given (--replicas or REPLICAS)")
+
+    router = Router(urls, args.vnodes, args.load_factor, args.unhealthy_after)
+    settings["timeout"] = args.timeout
+
+    # Keep-alive connections to the replicas, enough for every request in flight
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=64)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    threading.Thread(target=health_loop, args=(args.health_interval, 10), daemon=True).start()
+
+    logger.info(f"Gateway routing to {len(urls)} replicas: {', '.join(urls)}")
+    app.run(host='0.0.0.0', port=args.port, debug=False, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
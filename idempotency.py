@@ -0,0 +1,88 @@
+"""
+Idempotent request handling for the Stable Diffusion API
+
+Clients that retry after a timeout or a dropped connection send the same
+Idempotency-Key header again. A repeat of a request that is still running
+waits for the original instead of starting a second generation, and a repeat
+of a recently finished one gets the stored response back. Only successful
+responses are kept, so retrying after an error runs the request again.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Configuration (override with environment variables)
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "600"))  # Seconds a finished response is kept
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "32"))  # Finished responses kept (~1 MB each)
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a request with different parameters"""
+
+
+class _Entry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result = None
+        self.finished = None
+
+
+class IdempotencyCache:
+    """In-flight and recently finished results, keyed by Idempotency-Key"""
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, size=IDEMPOTENCY_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = max(size, 0)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> _Entry; finished ones in LRU order
+
+    def run(self, key, fingerprint, compute, keep=lambda result: True):
+        """Return (result, replayed), calling compute() only if no request with `key` ran recently
+
+        `fingerprint` identifies the request parameters; reusing a key with
+        different ones raises IdempotencyConflict. Results for which `keep`
+        returns False are handed to requests already waiting but not stored.
+        """
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None and entry.fingerprint != fingerprint:
+                raise IdempotencyConflict(f"Idempotency-Key '{key}' was already used with different parameters")
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = _Entry(fingerprint)
+            elif entry.finished is not None:
+                self._entries.move_to_end(key)
+
+        if not owner:
+            entry.done.wait()
+            if entry.result is not None:
+                return entry.result, True
+            return compute(), False  # The original failed outright; run it ourselves
+
+        try:
+            entry.result = compute()
+        finally:
+            with self._lock:
+                if entry.result is None or not keep(entry.result) or not self.size:
+                    self._entries.pop(key, None)
+                else:
+                    entry.finished = time.time()
+                    self._entries.move_to_end(key)
+                    self._trim()
+            entry.done.set()
+
+        return entry.result, False
+
+    def _expire(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e.finished is not None and now - e.finished > self.ttl]:
+            del self._entries[key]
+
+    def _trim(self):
+        finished = [k for k, e in self._entries.items() if e.finished is not None]
+        for key in finished[:max(0, len(finished) - self.size)]:
+            del self._entries[key]
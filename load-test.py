@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Load generator for the Stable Diffusion API
+
+Drives /generate either open-loop (Poisson arrivals at fixed rates, the way
+independent users show up) or closed-loop (a fixed number of clients that
+send their next request as soon as the previous one finishes). For every
+step it reports latency percentiles, throughput, error and 429 rates, and
+at the end the highest load the server sustains.
+
+    # Server backed by the tiny offline pipeline
+    MODEL_ID=tiny MAX_QUEUE=8 python app-cpu.py
+
+    python load-test.py --mode open --rates 1,2,4,8,16 --duration 30
+    python load-test.py --mode closed --concurrency 1,2,4,8 --duration 30
+
+Open-loop latencies are measured from the scheduled arrival time, so time a
+request spends waiting on a busy client counts against the server too.
+Requests still in flight when a step's arrival window closes are waited for
+and reported as its backlog; throughput is completions over the whole time
+the step took, including that drain.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def percentile(values, p):
+    """p-th percentile (0-100) using linear interpolation"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def send(session, args, scheduled):
+    """Send one request; returns (outcome, latency from `scheduled`)"""
+    payload = {
+        "prompt": args.prompt,
+        "steps": args.steps,
+        "width": args.size,
+        "height": args.size,
+        "seed": random.randint(0, 2**32 - 1)
+    }
+    try:
+        response = session.post(f"{args.url}/generate", json=payload, timeout=args.timeout)
+        status = response.status_code
+        outcome = "ok" if status == 200 else "rejected" if status == 429 else "error"
+    except requests.Timeout:
+        outcome = "timeout"
+    except requests.RequestException:
+        outcome = "error"
+    return outcome, scheduled, time.time() - scheduled
+
+
+def latency_growth(results):
+    """Median latency of the last third of arrivals over that of the first third
+
+    Stays near 1 while the server keeps up; a queue that keeps growing
+    during the step shows up as a steadily rising ratio.
+    """
+    ok = sorted((scheduled, latency) for outcome, scheduled, latency in results if outcome == "ok")
+    third = len(ok) // 3
+    if third < 2:
+        return None
+    first = percentile([latency for _, latency in ok[:third]], 50)
+    last = percentile([latency for _, latency in ok[-third:]], 50)
+    return last / first if first > 0 else None
+
+
+def summarize(label, results, window, elapsed):
+    """Collapse one load step into its report row
+
+    `window` is how long requests were being sent, `elapsed` how long the
+    step took until the last response came back.
+    """
+    latencies = [latency for outcome, _, latency in results if outcome == "ok"]
+    total = len(results)
+    count = lambda name: sum(1 for outcome, _, _ in results if outcome == name)
+
+    return {
+        "step": label,
+        "requests": total,
+        "arrival_rps": total / window,
+        "throughput_rps": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "latency_growth": latency_growth(results),
+        "error_rate": (count("error") + count("timeout")) / total if total else 0.0,
+        "rejected_rate": count("rejected") / total if total else 0.0
+    }
+
+
+def run_open_loop(args, rate):
+    """Poisson arrivals at `rate` requests/second for args.duration seconds"""
+    session = make_session(args.max_inflight)
+    results = []
+    lock = threading.Lock()
+    inflight = threading.BoundedSemaphore(args.max_inflight)
+    dropped = 0
+
+    def task(scheduled):
+        try:
+            outcome = send(session, args, scheduled)
+            with lock:
+                results.append(outcome)
+        finally:
+            inflight.release()
+
+    start = time.time()
+    next_arrival = start
+    with ThreadPoolExecutor(max_workers=args.max_inflight) as executor:
+        while True:
+            next_arrival += random.expovariate(rate)
+            if next_arrival - start >= args.duration:
+                break
+            time.sleep(max(0.0, next_arrival - time.time()))
+
+            # The client itself must never throttle arrivals; count it if it would
+            if not inflight.acquire(blocking=False):
+                dropped += 1
+                continue
+            executor.submit(task, next_arrival)
+
+    if dropped:
+        print(f"  ⚠️  {dropped} arrivals dropped: more than {args.max_inflight} requests in flight "
+              f"(raise --max-inflight)")
+        results.extend(("error", start, 0.0) for _ in range(dropped))
+
+    # The executor waited for the stragglers, so the step may have run past the window
+    elapsed = max(time.time() - start, args.duration)
+    window_end = start + args.duration
+    summary = summarize(f"{rate:g} rps", results, args.duration, elapsed)
+    summary["rate"] = rate
+    summary["backlog"] = sum(1 for _, scheduled, latency in results if scheduled + latency > window_end)
+    summary["drain_seconds"] = max(0.0, elapsed - args.duration)
+    return summary
+
+
+def run_closed_loop(args, concurrency):
+    """`concurrency` clients in a send / wait / send loop for args.duration seconds"""
+    session = make_session(concurrency)
+    results = []
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def client():
+        while time.time() < deadline:
+            outcome = send(session, args, time.time())
+            with lock:
+                results.append(outcome)
+            if outcome[0] == "rejected":
+                time.sleep(0.1)  # Don't spin on a server that is shedding load
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - start
+    summary = summarize(f"{concurrency} clients", results, elapsed, elapsed)
+    summary["concurrency"] = concurrency
+    summary["backlog"] = None  # Clients never have more than one request open
+    summary["drain_seconds"] = None
+    return summary
+
+
+def is_sustained(row, args):
+    """Whether the server kept up with this load step"""
+    if row["error_rate"] > args.max_error_rate or row["rejected_rate"] > args.max_error_rate:
+        return False
+    if args.slo is not None and (row["p99"] is None or row["p99"] > args.slo):
+        return False
+    if args.mode == "open" and row["latency_growth"] is not None and row["latency_growth"] > args.max_latency_growth:
+        return False  # Requests are queueing up faster than they are served
+    # A request arriving just before the window closes takes one service time to finish even on an
+    # idle server, so only a drain longer than the step's own p99 latency means requests piled up
+    drain_limit = max(row["p99"] or 0.0, args.duration * args.max_drain)
+    if args.mode == "open" and row["drain_seconds"] > drain_limit:
+        return False  # Backlog at the end of the window took too long to clear
+    return True
+
+
+def find_saturation(rows, args):
+    """Return (last sustained row, first saturated row) for the sweep"""
+    sustained = None
+    for row in rows:
+        if not is_sustained(row, args):
+            return sustained, row
+
+        # Closed loop: more clients no longer buys meaningfully more throughput
+        if args.mode == "closed" and sustained is not None:
+            if row["throughput_rps"] < sustained["throughput_rps"] * 1.1:
+                return sustained, row
+
+        sustained = row
+    return sustained, None
+
+
+def format_seconds(value):
+    return f"{value:.2f}s" if value is not None else "-"
+
+
+def print_report(rows, args):
+    print()
+    print(f"{'Step':<12} {'Reqs':>6} {'Arrive/s':>9} {'Thru/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} "
+          f"{'Errors':>7} {'429s':>7} {'Backlog':>8}")
+    for row in rows:
+        backlog = "-" if row["backlog"] is None else str(row["backlog"])
+        print(f"{row['step']:<12} {row['requests']:>6} {row['arrival_rps']:>9.2f} {row['throughput_rps']:>8.2f} "
+              f"{format_seconds(row['p50']):>8} {format_seconds(row['p95']):>8} {format_seconds(row['p99']):>8} "
+              f"{row['error_rate']:>6.1%} {row['rejected_rate']:>6.1%} {backlog:>8}")
+
+    sustained, saturated = find_saturation(rows, args)
+    print("\n📊 Saturation report:")
+    if sustained is None:
+        print(f"  ❌ Saturated already at the first step ({rows[0]['step']}) - start the sweep lower")
+        return
+
+    print(f"  Highest sustained load: {sustained['step']} -> {sustained['throughput_rps']:.2f} images/s, "
+          f"p99 {format_seconds(sustained['p99'])}")
+    if saturated is None:
+        print("  Not saturated within the sweep - extend it to find the limit")
+    else:
+        print(f"  Saturates at: {saturated['step']} (throughput {saturated['throughput_rps']:.2f}/s, "
+              f"p99 {format_seconds(saturated['p99'])}, errors {saturated['error_rate']:.1%}, "
+              f"429s {saturated['rejected_rate']:.1%}"
+              + (f", {saturated['backlog']} still in flight at the end of the window, "
+                 f"drained in {saturated['drain_seconds']:.1f}s" if saturated["backlog"] else "") + ")")
+    print(f"💡 Replicas needed for a target rate R: ceil(R / {sustained['throughput_rps']:.2f})")
+
+
+def parse_list(cast):
+    return lambda value: [cast(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open/closed-loop load test for /generate")
+    parser.add_argument("--url", default="http://localhost:8080", help="API base URL")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--rates", type=parse_list(float), default=[0.5, 1, 2, 4],
+                        help="Open loop: arrival rates to sweep, requests/second")
+    parser.add_argument("--concurrency", type=parse_list(int), default=[1, 2, 4, 8],
+                        help="Closed loop: client counts to sweep")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds per load step")
+    parser.add_argument("--prompt", default="a simple test image")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds")
+    parser.add_argument("--max-inflight", type=int, default=256, help="Open loop: client side cap on open requests")
+    parser.add_argument("--slo", type=float, default=None, help="p99 latency limit in seconds for a step to count as sustained")
+    parser.add_argument("--max-error-rate", type=float, default=0.01,
+                        help="Error or 429 rate above which a step counts as saturated")
+    parser.add_argument("--max-latency-growth", type=float, default=1.5,
+                        help="Open loop: late/early median latency ratio above which the queue counts as growing")
+    parser.add_argument("--max-drain", type=float, default=0.25,
+                        help="Open loop: time to clear the backlog after a step, as a fraction of --duration, "
+                             "above which the step counts as saturated (never less than the step's p99 latency)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    try:
+        health = requests.get(f"{args.url}/health", timeout=10).json()
+    except Exception as e:
+        print(f"❌ Health check failed: {e}")
+        sys.exit(1)
+    print(f"🔍 Target {args.url}: {health}")
+
+    steps = args.rates if args.mode == "open" else args.concurrency
+    rows = []
+    for value in steps:
+        label = f"{value:g} rps" if args.mode == "open" else f"{value} clients"
+        print(f"\n▶ {label} for {args.duration:g}s...")
+        row = run_open_loop(args, value) if args.mode == "open" else run_closed_loop(args, value)
+        rows.append(row)
+        print(f"  {row['requests']} requests, {row['throughput_rps']:.2f}/s, p99 {format_seconds(row['p99'])}, "
+              f"errors {row['error_rate']:.1%}, 429s {row['rejected_rate']:.1%}"
+              + (f", backlog {row['backlog']}" if row["backlog"] else ""))
+
+    print_report(rows, args)
+
+    if args.json:
+        sustained, saturated = find_saturation(rows, args)
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "health": health, "steps": rows,
+                       "sustained": sustained, "saturated": saturated}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+LoRA adapter cache for the Stable Diffusion API
+
+Adapters are loaded on demand from LORA_DIR (one <name>.safetensors file per
+adapter) into the shared pipeline, so a request can pick its own style without
+reloading the model. Each adapter set is merged straight into the UNet and
+text encoder weights so generation runs at base model speed, and the merged
+deltas of recently used sets are kept around so switching back is just a
+weight copy.
+"""
+
+import os
+import re
+import math
+import time
+import threading
+import logging
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Configuration (override with environment variables)
+LORA_DIR = os.environ.get("LORA_DIR", "loras")
+LORA_CACHE_SIZE = int(os.environ.get("LORA_CACHE_SIZE", "8"))  # Adapters kept loaded
+LORA_MERGED_CACHE_SIZE = int(os.environ.get("LORA_MERGED_CACHE_SIZE", "2"))  # Merged sets kept in memory (full-size deltas)
+LORA_MAX_GROUP = int(os.environ.get("LORA_MAX_GROUP", "4"))  # Same-set requests served before yielding
+
+# Adapter names double as peft module keys, so no dots or path separators
+LORA_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class LoraManager:
+    """Loads, merges and swaps LoRA adapter sets on a shared pipeline"""
+
+    def __init__(self, pipeline, lora_dir=LORA_DIR, cache_size=LORA_CACHE_SIZE,
+                 merged_cache_size=LORA_MERGED_CACHE_SIZE, max_group=LORA_MAX_GROUP):
+        self.pipeline = pipeline
+        self.lora_dir = lora_dir
+        self.cache_size = max(cache_size, 1)
+        self.merged_cache_size = max(merged_cache_size, 0)
+        self.max_group = max(max_group, 1)
+
+        self._adapters = OrderedDict()  # name -> None, in LRU order
+        self._merged = OrderedDict()  # adapter set -> {layer: delta}, in LRU order
+        self._originals = {}  # layer -> untouched base weight (a full copy of every layer a LoRA touches)
+        self._applied = ()  # adapter set currently merged into the weights
+        self._applied_layers = set()  # layers whose weights currently include a delta
+
+        # Requests share one pipeline, so they take turns. Waiting requests for
+        # the adapter set that is already applied go first (up to max_group in
+        # a row) so we don't thrash between sets under mixed load.
+        self._cond = threading.Condition()
+        self._busy = False
+        self._waiting = Counter()
+        self._streak = 0
+
+    def parse(self, loras):
+        """Validate the 'loras' request parameter and return a hashable adapter set"""
+        if loras is None:
+            return ()
+        if not isinstance(loras, list):
+            raise ValueError("'loras' must be a list of {\"name\": ..., \"weight\": ...} objects")
+        if loras and self.lora_dir is None:
+            raise ValueError("LoRA adapters are not supported by this inference backend")
+
+        adapters = {}
+        for item in loras:
+            if not isinstance(item, dict) or 'name' not in item:
+                raise ValueError("Each LoRA must be an object with a 'name' and optional 'weight'")
+
+            name = item['name']
+            if not isinstance(name, str) or not LORA_NAME_PATTERN.match(name):
+                raise ValueError(f"Invalid LoRA name: {name!r}")
+            if name in adapters:
+                raise ValueError(f"LoRA '{name}' given more than once")
+            if not os.path.isfile(self._path(name)):
+                raise ValueError(f"LoRA '{name}' not found")
+
+            weight = item.get('weight', 1.0)
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not math.isfinite(weight):
+                raise ValueError(f"Invalid weight for LoRA '{name}'")
+            weight = float(weight)
+
+            if weight != 0.0:
+                adapters[name] = weight
+
+        if len(adapters) > self.cache_size:
+            raise ValueError(f"At most {self.cache_size} LoRAs can be combined in one request")
+
+        return tuple(sorted(adapters.items()))
+
+    @contextmanager
+    def activate(self, adapter_set):
+        """Wait for the pipeline, apply adapter_set to it and hold it while generating"""
+        with self._cond:
+            self._waiting[adapter_set] += 1
+            try:
+                while self._busy or not self._may_run(adapter_set):
+                    self._cond.wait()
+            finally:
+                self._waiting[adapter_set] -= 1
+                if not self._waiting[adapter_set]:
+                    del self._waiting[adapter_set]  # Keep the scan in _may_run short
+            self._busy = True
+            self._streak = self._streak + 1 if adapter_set == self._applied else 1
+
+        try:
+            self._apply(adapter_set)
+            yield
+        finally:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _may_run(self, adapter_set):
+        """Decide whether a waiting request may take the pipeline next"""
+        others_waiting = any(count for key, count in self._waiting.items() if key != self._applied)
+        if adapter_set == self._applied:
+            return self._streak < self.max_group or not others_waiting
+        return self._waiting[self._applied] == 0 or self._streak >= self.max_group
+
+    def _path(self, name):
+        return os.path.join(self.lora_dir, f"{name}.safetensors")
+
+    def _load(self, name):
+        """Make sure adapter `name` is loaded, evicting the least recently used one if needed"""
+        if name in self._adapters:
+            self._adapters.move_to_end(name)
+            return
+
+        while len(self._adapters) >= self.cache_size:
+            evicted, _ = self._adapters.popitem(last=False)
+            self.pipeline.delete_adapters(evicted)
+            logger.info(f"Evicted LoRA '{evicted}'")
+
+        start = time.time()
+        try:
+            self.pipeline.load_lora_weights(self.lora_dir, weight_name=f"{name}.safetensors", adapter_name=name)
+        except Exception:
+            # peft may have injected part of the adapter before failing (e.g. a LoRA for another
+            # architecture); take it out again so it doesn't leak into every later forward pass
+            if name in self._registered_adapters():
+                self.pipeline.delete_adapters(name)
+            self.pipeline.disable_lora()
+            raise
+        # We merge adapters into the weights ourselves, so keep the peft layers out of the forward pass
+        self.pipeline.disable_lora()
+        self._adapters[name] = None
+        logger.info(f"Loaded LoRA '{name}' in {time.time() - start:.2f}s")
+
+    def _registered_adapters(self):
+        """Adapter names peft currently knows about in the UNet or text encoder"""
+        names = set()
+        for layer in self._lora_layers():
+            names.update(layer.lora_A.keys())
+        return names
+
+    def _lora_layers(self):
+        from peft.tuners.lora import LoraLayer
+
+        for model in (self.pipeline.unet, self.pipeline.text_encoder):
+            for module in model.modules():
+                if isinstance(module, LoraLayer):
+                    yield module
+
+    def _deltas(self, adapter_set):
+        """Return the merged weight deltas for adapter_set, computing them if not cached"""
+        if adapter_set in self._merged:
+            self._merged.move_to_end(adapter_set)
+            return self._merged[adapter_set]
+
+        for name, _ in adapter_set:
+            self._load(name)
+
+        deltas = {}
+        with torch.no_grad():
+            for layer in self._lora_layers():
+                delta = None
+                for name, weight in adapter_set:
+                    if name in layer.lora_A:
+                        term = layer.get_delta_weight(name) * weight
+                        delta = term if delta is None else delta + term
+                if delta is not None:
+                    deltas[layer] = delta
+
+        if self.merged_cache_size:
+            self._merged[adapter_set] = deltas
+            while len(self._merged) > self.merged_cache_size:
+                self._merged.popitem(last=False)
+
+        return deltas
+
+    def _apply(self, adapter_set):
+        """Swap the merged weights of the current adapter set for those of adapter_set"""
+        if adapter_set == self._applied:
+            return
+
+        start = time.time()
+        deltas = self._deltas(adapter_set) if adapter_set else {}
+
+        with torch.no_grad():
+            # Restore the layers touched by the previous set before merging the new one
+            for layer in self._applied_layers:
+                layer.get_base_layer().weight.copy_(self._originals[layer])
+
+            for layer, delta in deltas.items():
+                base_weight = layer.get_base_layer().weight
+                if layer not in self._originals:
+                    self._originals[layer] = base_weight.detach().clone()
+                base_weight.add_(delta.to(device=base_weight.device, dtype=base_weight.dtype))
+
+        self._applied = adapter_set
+        self._applied_layers = set(deltas)
+
+        names = ", ".join(f"{name}:{weight}" for name, weight in adapter_set) or "none"
+        logger.info(f"Switched LoRA set to [{names}] in {(time.time() - start) * 1000:.0f} ms")
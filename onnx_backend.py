@@ -0,0 +1,284 @@
+"""
+ONNX Runtime / OpenVINO inference backend
+
+Exports the text encoder, UNet and VAE decoder of a loaded PyTorch pipeline
+to ONNX once (cached on disk together with the tokenizer and scheduler, so a
+cached model starts without loading the PyTorch weights at all) and serves
+them through ONNX Runtime with full graph optimizations, optionally using the
+OpenVINO execution provider. The resulting pipeline takes the same
+arguments as StableDiffusionPipeline, including a seeded torch.Generator, so
+the API code does not need to know which backend it is running on.
+"""
+
+import os
+import re
+import json
+import fcntl
+import shutil
+import inspect
+import tempfile
+import logging
+
+import torch
+import diffusers
+from diffusers import OnnxRuntimeModel, OnnxStableDiffusionPipeline
+from transformers import CLIPTokenizer
+
+logger = logging.getLogger(__name__)
+
+# Configuration (override with environment variables)
+ONNX_CACHE_DIR = os.environ.get("ONNX_CACHE_DIR", os.path.expanduser("~/.cache/onnx"))
+ONNX_OPSET = 14
+
+# Execution providers per backend, in order of preference
+BACKEND_PROVIDERS = {
+    "onnxruntime": ["CPUExecutionProvider"],
+    "openvino": ["OpenVINOExecutionProvider", "CPUExecutionProvider"]
+}
+
+ONNX_MODELS = ("text_encoder", "unet", "vae_decoder")
+
+# Files that must all be present for an export to count as a cache hit
+EXPORT_FILES = [os.path.join(name, "model.onnx") for name in ONNX_MODELS] + [
+    os.path.join("tokenizer", "tokenizer_config.json"),
+    os.path.join("scheduler", "scheduler_config.json")
+]
+
+
+class UNetWrapper(torch.nn.Module):
+    """Return the UNet output as a plain tensor so it can be traced"""
+
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)[0]
+
+
+class VaeDecoderWrapper(torch.nn.Module):
+    """Expose AutoencoderKL.decode as the module forward"""
+
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent_sample):
+        return self.vae.decode(latent_sample, return_dict=False)[0]
+
+
+class TorchSeededOnnxPipeline(OnnxStableDiffusionPipeline):
+    """OnnxStableDiffusionPipeline that accepts a torch.Generator like the PyTorch pipeline
+
+    The initial latents are drawn from the torch generator exactly as
+    StableDiffusionPipeline does, so a given seed produces the same image on
+    every backend.
+    """
+
+    def __call__(self, prompt=None, height=512, width=512, generator=None, latents=None, **kwargs):
+        if latents is None and isinstance(generator, torch.Generator):
+            shape = (1, 4, height // 8, width // 8)
+            latents = torch.randn(shape, generator=generator, dtype=torch.float32).numpy()
+            generator = None
+
+        return super().__call__(
+            prompt=prompt,
+            height=height,
+            width=width,
+            generator=generator,
+            latents=latents,
+            **kwargs
+        )
+
+
+def onnx_export(model, args, output_path, input_names, output_names, dynamic_axes):
+    """Export a module with the TorchScript based exporter"""
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # Newer torch defaults to the dynamo exporter
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            args,
+            output_path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            do_constant_folding=True,
+            opset_version=ONNX_OPSET,
+            **kwargs
+        )
+
+
+def export_pipeline(pipeline, output_dir):
+    """Export the text encoder, UNet and VAE decoder of `pipeline` to `output_dir`"""
+    # Export to a private scratch directory so an interrupted export is never picked up as a
+    # cache hit and processes exporting side by side can't touch each other's files
+    os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(output_dir), prefix=os.path.basename(output_dir) + ".tmp-")
+    try:
+        _export_to(pipeline, tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if is_exported(output_dir):
+        shutil.rmtree(tmp_dir)  # Someone else finished first; never replace a complete export
+        return
+    shutil.rmtree(output_dir, ignore_errors=True)  # Leftovers of an incomplete export
+    os.replace(tmp_dir, output_dir)
+
+
+def _export_to(pipeline, tmp_dir):
+    """Write the ONNX models, tokenizer and scheduler of `pipeline` into `tmp_dir`"""
+    import onnx
+
+    text_encoder = pipeline.text_encoder
+    unet = pipeline.unet
+    vae = pipeline.vae
+
+    # Plain attention exports on every torch version and ONNX Runtime fuses it anyway,
+    # so drop attention slicing and friends for the export
+    unet.set_default_attn_processor()
+    vae.set_default_attn_processor()
+
+    num_tokens = pipeline.tokenizer.model_max_length
+    text_hidden_size = text_encoder.config.hidden_size
+    latent_size = unet.config.sample_size
+    latent_channels = unet.config.in_channels
+
+    logger.info("Exporting text encoder to ONNX...")
+    onnx_export(
+        text_encoder,
+        (torch.zeros((1, num_tokens), dtype=torch.int32),),
+        os.path.join(tmp_dir, "text_encoder", "model.onnx"),
+        input_names=["input_ids"],
+        output_names=["last_hidden_state", "pooler_output"],
+        dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}}
+    )
+
+    logger.info("Exporting UNet to ONNX...")
+    unet_path = os.path.join(tmp_dir, "unet", "model.onnx")
+    onnx_export(
+        UNetWrapper(unet),
+        (
+            torch.randn(2, latent_channels, latent_size, latent_size),
+            torch.tensor([1.0]),
+            torch.randn(2, num_tokens, text_hidden_size)
+        ),
+        unet_path,
+        input_names=["sample", "timestep", "encoder_hidden_states"],
+        output_names=["out_sample"],
+        dynamic_axes={
+            "sample": {0: "batch", 2: "height", 3: "width"},
+            "encoder_hidden_states": {0: "batch", 1: "sequence"}
+        }
+    )
+
+    # The full UNet is over the 2GB protobuf limit, so its weights go into a single side file
+    unet_model = onnx.load(unet_path)
+    shutil.rmtree(os.path.dirname(unet_path))
+    os.makedirs(os.path.dirname(unet_path))
+    onnx.save_model(
+        unet_model,
+        unet_path,
+        save_as_external_data=True,
+        all_tensors_to_one_file=True,
+        location="weights.pb"
+    )
+    del unet_model
+
+    logger.info("Exporting VAE decoder to ONNX...")
+    onnx_export(
+        VaeDecoderWrapper(vae),
+        (torch.randn(1, vae.config.latent_channels, latent_size, latent_size),),
+        os.path.join(tmp_dir, "vae_decoder", "model.onnx"),
+        input_names=["latent_sample"],
+        output_names=["sample"],
+        dynamic_axes={"latent_sample": {0: "batch", 2: "height", 3: "width"}}
+    )
+
+    # Everything else the pipeline needs, so a cache hit doesn't need the PyTorch model
+    pipeline.tokenizer.save_pretrained(os.path.join(tmp_dir, "tokenizer"))
+    pipeline.scheduler.save_pretrained(os.path.join(tmp_dir, "scheduler"))
+
+
+def create_session(model_path, backend):
+    """Create an ONNX Runtime session for `model_path` using the providers of `backend`"""
+    import onnxruntime as ort
+
+    providers = [p for p in BACKEND_PROVIDERS[backend] if p in ort.get_available_providers()]
+    if providers[0] != BACKEND_PROVIDERS[backend][0]:
+        raise RuntimeError(
+            f"{BACKEND_PROVIDERS[backend][0]} is not available - "
+            f"install {'onnxruntime-openvino' if backend == 'openvino' else 'onnxruntime'}"
+        )
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()  # Honour the same thread settings as PyTorch
+
+    return ort.InferenceSession(model_path, sess_options=options, providers=providers)
+
+
+def export_dir(model_id, cache_dir=ONNX_CACHE_DIR):
+    return os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "--", model_id), f"opset{ONNX_OPSET}")
+
+
+def is_exported(model_dir):
+    return all(os.path.isfile(os.path.join(model_dir, name)) for name in EXPORT_FILES)
+
+
+def load_scheduler(model_dir):
+    """Load the scheduler saved with the export, whatever its class"""
+    config_path = os.path.join(model_dir, "scheduler", "scheduler_config.json")
+    with open(config_path) as f:
+        scheduler_class = getattr(diffusers, json.load(f)["_class_name"])
+    return scheduler_class.from_pretrained(model_dir, subfolder="scheduler")
+
+
+def load_onnx_pipeline(model_id, backend, load_pipeline, cache_dir=ONNX_CACHE_DIR):
+    """Build an ONNX backed pipeline for `model_id`, exporting it on first use
+
+    `load_pipeline` returns the PyTorch pipeline for the model. It is only
+    called when there is no cached export yet.
+    """
+    if backend not in BACKEND_PROVIDERS:
+        raise ValueError(f"Unknown ONNX backend '{backend}' (expected one of: {', '.join(BACKEND_PROVIDERS)})")
+
+    model_dir = export_dir(model_id, cache_dir)
+    if is_exported(model_dir):
+        logger.info(f"Using cached ONNX export from {model_dir}")
+    else:
+        # Replicas sharing the cache take turns, so only one of them exports the model
+        os.makedirs(os.path.dirname(model_dir), exist_ok=True)
+        with open(model_dir + ".lock", "w") as lock_file:
+            logger.info("Waiting for the ONNX export lock...")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+            if is_exported(model_dir):
+                logger.info(f"Using ONNX export another process just finished in {model_dir}")
+            else:
+                logger.info(f"No cached ONNX export found, exporting to {model_dir} (this only happens once)...")
+                export_pipeline(load_pipeline(), model_dir)
+
+    logger.info(f"Creating {backend} sessions...")
+    models = {
+        name: OnnxRuntimeModel(model=create_session(os.path.join(model_dir, name, "model.onnx"), backend))
+        for name in ONNX_MODELS
+    }
+
+    onnx_pipeline = TorchSeededOnnxPipeline(
+        vae_encoder=None,
+        vae_decoder=models["vae_decoder"],
+        text_encoder=models["text_encoder"],
+        tokenizer=CLIPTokenizer.from_pretrained(model_dir, subfolder="tokenizer"),
+        unet=models["unet"],
+        scheduler=load_scheduler(model_dir),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    return onnx_pipeline
@@ -0,0 +1,102 @@
+"""
+Tiny randomly initialised Stable Diffusion pipeline
+
+Builds a pipeline with the same structure as runwayml/stable-diffusion-v1-5
+but only a few hundred thousand parameters, entirely offline (no Hub
+download). The images are noise, but every code path of the API runs in
+well under a second, which makes it useful for parity checks and benchmarks
+of the serving stack itself.
+"""
+
+import os
+import json
+import tempfile
+
+import torch
+from diffusers import StableDiffusionPipeline, UNet2DConditionModel, AutoencoderKL, PNDMScheduler
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+
+def build_tokenizer():
+    """Character level CLIP tokenizer (byte alphabet, no merges)"""
+    vocab_dir = tempfile.mkdtemp(prefix="tiny-clip-")
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for suffix in ("", "</w>"):
+        for char in bytes_to_unicode().values():
+            vocab[char + suffix] = len(vocab)
+
+    vocab_file = os.path.join(vocab_dir, "vocab.json")
+    merges_file = os.path.join(vocab_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def build_tiny_pipeline(seed=0):
+    """Build a tiny StableDiffusionPipeline with deterministic random weights"""
+    tokenizer = build_tokenizer()
+
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+
+        unet = UNet2DConditionModel(
+            sample_size=8,
+            in_channels=4,
+            out_channels=4,
+            block_out_channels=(32, 64),
+            layers_per_block=1,
+            down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+            up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+            cross_attention_dim=32,
+            attention_head_dim=4
+        )
+
+        # Four blocks so the latents are 1/8 of the image size, like the real VAE
+        vae = AutoencoderKL(
+            in_channels=3,
+            out_channels=3,
+            block_out_channels=(8, 8, 8, 8),
+            layers_per_block=1,
+            norm_num_groups=8,
+            down_block_types=("DownEncoderBlock2D",) * 4,
+            up_block_types=("UpDecoderBlock2D",) * 4,
+            latent_channels=4
+        )
+
+        text_encoder = CLIPTextModel(CLIPTextConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=32,
+            intermediate_size=37,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            bos_token_id=0,
+            eos_token_id=1,
+            pad_token_id=1
+        ))
+
+    # Same scheduler settings as stable-diffusion-v1-5
+    scheduler = PNDMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        skip_prk_steps=True,
+        set_alpha_to_one=False,
+        steps_offset=1
+    )
+
+    pipeline = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline